@@ -1,28 +1,34 @@
 #!/usr/bin/env python3
 
 from types import GeneratorType
-from ctypes import CDLL, CFUNCTYPE, c_char_p, c_int, c_uint32
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from ctypes import CDLL, CFUNCTYPE, byref, c_char_p, c_int, c_uint32, c_ulong, c_void_p, sizeof
 from ctypes.util import find_library
 import argparse
 from datetime import datetime
-import multiprocessing
 import os
-import pathlib
 import re
+import select
 import shlex
 import signal
+import stat
 import struct
 import sys
 import textwrap
 import time
 
-def _print_verbose(*args):
+def _noop(*args):
     pass
 
+_print_verbose = _noop
+
 __libc = CDLL(find_library("c"))
 
 inotify_init = CFUNCTYPE(c_int)(("inotify_init", __libc), ())
-inotify_init1 = CFUNCTYPE(c_int, c_int)(("inotify_init", __libc), ((1, "flags"),))
+inotify_init1 = CFUNCTYPE(c_int, c_int)(("inotify_init1", __libc), ((1, "flags"),))
+
+_IN_NONBLOCK = 0x00000800
 
 inotify_add_watch = CFUNCTYPE(c_int, c_int, c_char_p, c_uint32)(
                         ("inotify_add_watch", __libc), ((1, "fd"), (1, "pathname"), (1, "mask")))
@@ -30,6 +36,24 @@ inotify_add_watch = CFUNCTYPE(c_int, c_int, c_char_p, c_uint32)(
 inotify_rm_watch = CFUNCTYPE(c_int, c_int, c_int)(
                        ("inotify_rm_watch", __libc), ((1, "fd"), (1, "wd")))
 
+# glibc sigset_t, 1024 bits
+_sigset_t = c_ulong * (1024 // (8 * sizeof(c_ulong)))
+
+_SFD_NONBLOCK = 0x00000800
+
+signalfd = CFUNCTYPE(c_int, c_int, c_void_p, c_int)(
+               ("signalfd", __libc), ((1, "fd"), (1, "mask"), (1, "flags")))
+
+# struct signalfd_siginfo is 128 bytes and starts with ssi_signo
+_SIGINFO_SIZE = 128
+_SIGINFO_SIGNO = struct.Struct('I')
+
+# SIGQUIT exits with status code 2 as at timeout, SIGUSR1 reveals watch descriptors
+_HANDLED_SIGNALS = {signal.SIGQUIT, signal.SIGUSR1}
+
+# signal mask of the caller of wait(), restored when watching ends. signals it already blocked stay its own.
+_saved_signal_mask = frozenset()
+
 _EVENTS = {
     "ACCESS"           : 0x00000001,
     "MODIFY"           : 0x00000002,
@@ -59,79 +83,218 @@ _EVENTS = {
     "ONESHOT"          : 0x80000000
 }
 
+# masks tested for every event in _detect, bound once instead of looked up in _EVENTS
+_MASK_CREATE       = _EVENTS["CREATE"]
+_MASK_DELETE       = _EVENTS["DELETE"]
+_MASK_DELETE_SELF  = _EVENTS["DELETE_SELF"]
+_MASK_IGNORED      = _EVENTS["IGNORED"]
+_MASK_ISDIR        = _EVENTS["ISDIR"]
+_MASK_CREATE_ISDIR = _MASK_CREATE | _MASK_ISDIR
+_MASK_DELETE_ISDIR = _MASK_DELETE | _MASK_ISDIR
+
 _watch_descriptors = {}
 
+# large enough to take a whole burst of queued events in a single read(2)
+_BUFFER_SIZE = 65536
+# reused by every read. _parse_events copies names out before the next read refills it.
+_read_buffer = bytearray(_BUFFER_SIZE)
+_read_view = memoryview(_read_buffer)
+
+# struct inotify_event header: wd, mask, cookie, len. the name follows, NUL-padded to len bytes.
+_EVENT_HEADER = struct.Struct('iIII')
+_EVENT_HEADER_SIZE = _EVENT_HEADER.size
+
+# (bit, name) pairs to decode a mask, built once. MOVE is left out as it only aliases MOVED_FROM | MOVED_TO.
+_FLAG_TABLE = tuple((v, k) for k, v in _EVENTS.items() if k != "MOVE")
+
+# observed masks are few (CREATE, MODIFY, CREATE|ISDIR, ...), so decoding is memoized per mask.
+@lru_cache(maxsize=4096)
 def _decode_flag(flag):
-    flag_names = _EVENTS.copy()
-    del flag_names["MOVE"]
-    r = []
-    for n in flag_names.keys():
-        if _EVENTS[n] & flag != 0:
-            r.append(n)
-    return r
+    return tuple(n for b, n in _FLAG_TABLE if b & flag)
+
+@lru_cache(maxsize=4096)
+def _flag_string(flag):
+    return ",".join(_decode_flag(flag))
 
 def _handler(signum, frame):
     sys.exit(2)
 
-def _kill_timer(timeout, pid):
-    _print_verbose(f"wait for {timeout} seconds")
-    time.sleep(timeout)
-    _print_verbose("kill main process")
-    os.kill(pid, signal.SIGQUIT)
-    #sys.exit(2)
-
-_process = None
-def _reset(timeout, pid):
-    global _process
-    if _process:
-        _print_verbose("kill process")
-        _process.kill()
-    _process = multiprocessing.Process(target=_kill_timer, args=(timeout, pid))
-    _print_verbose("start process")
-    _process.start()
-
-_pid = os.getpid()
-def _detect_inotify(fd, timeout):
+def _open_signalfd(signums):
+    sigset = _sigset_t()
+    bits = 8 * sizeof(c_ulong)
+    for signum in signums:
+        sigset[(signum - 1) // bits] |= 1 << ((signum - 1) % bits)
+    return signalfd(-1, byref(sigset), _SFD_NONBLOCK)
+
+def _receive_signals(signal_fd):
+    # signals are read from the signalfd and handled here in the event loop, not in an asynchronous handler
+    while True:
+        try:
+            siginfo = os.read(signal_fd, _SIGINFO_SIZE)
+        except BlockingIOError:
+            return
+        signum = _SIGINFO_SIGNO.unpack_from(siginfo)[0]
+        _print_verbose(f"received signal {signum}")
+        if signum == signal.SIGQUIT:
+            _handler(signum, None)
+        elif signum == signal.SIGUSR1:
+            print(_watch_descriptors, flush=True)
+
+def _block_signals():
+    global _saved_signal_mask
+    _saved_signal_mask = frozenset(signal.pthread_sigmask(signal.SIG_BLOCK, _HANDLED_SIGNALS))
+
+def _owned_signals():
+    # the handled signals blocked by wait() itself. ones the caller blocked, and may have pending, are left alone.
+    return _HANDLED_SIGNALS - _saved_signal_mask
+
+def _release_signals():
+    # run as a command the process is exiting, and unblocking would let a late SIGUSR1 or SIGQUIT kill it
+    # with the default action instead of the exit status already chosen. so they stay blocked to the end.
+    if __name__ == '__main__':
+        return
+    # discard what is still pending, otherwise restoring the mask would deliver it with the default action
+    owned = _owned_signals()
+    while owned and signal.sigtimedwait(owned, 0):
+        pass
+    signal.pthread_sigmask(signal.SIG_SETMASK, _saved_signal_mask)
+
+def _parse_events(buf):
+    # split one read into (wd, mask, name) events in a single pass, without suspending per event
+    events = []
+    append = events.append
+    unpack_from = _EVENT_HEADER.unpack_from
+    i = 0
+    end = len(buf)
+    while i < end:
+        wd, mask, cookie, name_len = unpack_from(buf, i)
+        i += _EVENT_HEADER_SIZE
+        append((wd, mask, bytes(buf[i:i+name_len]).rstrip(b'\0')))
+        i += name_len
+    return events
+
+def _detect_inotify(fd, poller, signal_fd, deadline):
     try:
-        global _pid
-        if timeout > 0:
-            _reset(timeout, _pid)
-        buf = os.read(fd, 4096)
-
-        i = 0
-        fmt = 'iIII'
-        fmt_size = struct.calcsize(fmt)
-        while i < len(buf):
-            wd, mask, cookie, name_len = struct.unpack_from(fmt, buf, i)
-            i += fmt_size
-            name = buf[i:i+name_len]
-            i += name_len
-            _print_verbose("wd: {} mask: {:08x} path: {}".format(wd, mask, name.decode()))
-            yield [wd, mask, name.decode()]
+        # wait only for what is left until the deadline, so a wakeup by a signal does not restart the timeout
+        if deadline is None:
+            remaining = -1
+        else:
+            remaining = max(0, deadline - time.monotonic())
+            _print_verbose(f"wait for {remaining:.3f} seconds")
+        # write out what the previous wakeup produced before blocking
+        sys.stdout.flush()
+        ready = [ready_fd for ready_fd, _ in poller.poll(remaining)]
+        if signal_fd in ready:
+            _receive_signals(signal_fd)
+        # timed out when the deadline has passed without the inotify fd becoming ready, even if a signal arrived
+        if fd not in ready and deadline is not None and (not ready or time.monotonic() >= deadline):
+            _print_verbose("timeout")
+            _handler(signal.SIGQUIT, None)
+        # a single read may not drain the queue, so read until the non-blocking fd runs dry
+        while True:
+            try:
+                n = os.readv(fd, [_read_buffer])
+            except BlockingIOError:
+                break
+
+            events = _parse_events(_read_view[:n])
+            if _print_verbose is not _noop:
+                for wd, mask, name in events:
+                    _print_verbose("wd: {} mask: {:08x} path: {}".format(wd, mask, os.fsdecode(name)))
+            yield from events
     except KeyboardInterrupt:
         _print_verbose("KeyboardInterrupt")
         print("", flush=True)
         sys.exit(130)
 
-_format_string = ""
-_timefmt_string = ""
+# --format conversions: %%, %w, %f, %e or %Xe, %T
+_FORMAT_RE = re.compile(r"%(?:(%)|(w)|(f)|(.?)e|(T))")
+_TIME_RE = re.compile('%T')
+
+def _compile_format(format_string, timefmt_string):
+    # translate a --format string into a str.format template once, so each event is a single format_map call.
+    # conversions: %% is a literal %, %w directory, %f file name, %e or %Xe events joined by "," or X, %T time.
+    template = []
+    separators = {}
+    has_time = False
+    pos = 0
+    for m in _FORMAT_RE.finditer(format_string):
+        template.append(format_string[pos:m.start()].replace('{', '{{').replace('}', '}}'))
+        pos = m.end()
+        if m.lastindex == 1:
+            template.append('%')
+        elif m.lastindex == 2:
+            template.append('{w}')
+        elif m.lastindex == 3:
+            template.append('{f}')
+        elif m.lastindex == 4:
+            separator = m.group(4) or ","
+            key = separators.setdefault(separator, f"e{len(separators)}")
+            template.append('{' + key + '}')
+        else:
+            template.append('{T}')
+            has_time = True
+    template.append(format_string[pos:].replace('{', '{{').replace('}', '}}'))
+    template = "".join(template)
+    # joined event strings per separator, keyed by the flags as a tuple. observed flags are few, so a handful of keys covers a run.
+    separators = tuple((separator, key, {}) for separator, key in separators.items())
+
+    def format_output(directory, flags, name):
+        fields = {"w": directory, "f": name}
+        flags = tuple(flags)
+        for separator, key, joined in separators:
+            value = joined.get(flags)
+            if value is None:
+                value = joined[flags] = separator.join(flags)
+            fields[key] = value
+        if has_time:
+            fields["T"] = datetime.now().strftime(timefmt_string)
+        return template.format_map(fields)
+    return format_output
+
+_format_output = _compile_format('%w %e %f', None)
 def _output_as_main(directory, flags, name):
-    global _format_string, _timefmt_string
-    if _format_string:
-        format_string = _format_string.replace('%%', '\0')
-        seps = re.findall("%(.?)e", format_string)
-    else:
-        format_string = '%w %e %f'
-        seps = [""]
-    output = format_string.replace('%w', directory).replace('%f', name)
-    for sep in seps:
-        separator = "," if not sep else sep
-        #print(f"pattern = {'%' + sep + 'e'} separator = {separator} flags = {flags}")
-        output = output.replace('%' + sep + 'e', separator.join(flags), 1)
-    if "%T" in output:
-        output = output.replace('%T', datetime.now().strftime(_timefmt_string))
-    output = output.replace('\0', '%')
-    print(output, flush=True)
+    # buffered only. the lines of one wakeup go out together when _detect_inotify flushes before waiting again.
+    sys.stdout.buffer.write(os.fsencode(_format_output(directory, flags, name) + "\n"))
+
+def _list_subdirectories(path):
+    # return the subdirectories of path as "path/", and the ones to descend into.
+    # DirEntry carries the file type from readdir, so entries need no stat of their own.
+    found = []
+    descend = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    found.append(entry.path + os.sep)
+                    # like os.walk, a symlink to a directory is watched but not descended into
+                    if not entry.is_symlink():
+                        descend.append(entry.path)
+    except OSError:
+        pass
+    return found, descend
+
+def _walk_directories(top, executor=None):
+    # return every directory under top as "path/", one tree level at a time.
+    # with an executor, the directories of a level are scanned concurrently.
+    directories = []
+    pending = [top]
+    while pending:
+        scanned = (executor.map if executor and len(pending) > 1 else map)(_list_subdirectories, pending)
+        pending = []
+        for found, descend in scanned:
+            directories.extend(found)
+            pending.extend(descend)
+    return directories
+
+def _add_watches(fd, paths, mask, executor=None):
+    # inotify_add_watch releases the GIL, so with an executor the syscalls for many paths overlap.
+    # watches are recorded in one update, in the order of paths.
+    add_watch = lambda path: inotify_add_watch(fd, os.fsencode(path), mask)
+    wds = list((executor.map if executor and len(paths) > 1 else map)(add_watch, paths))
+    for path, wd in zip(paths, wds):
+        _print_verbose("inotify_add_watch {} {} {} => {}".format(fd, path, _flag_string(mask), wd))
+    _watch_descriptors.update(zip(wds, paths))
 
 _status_code = 0
 _include_create_event = False
@@ -197,14 +360,13 @@ https://docs.python.org/ja/3/library/datetime.html#strftime-and-strptime-format-
         sys.exit(1)
          
     # reject --format option if --timefmt option is not specified in format which include it
-    if output_format and re.search('%T', output_format) and not time_format:
+    if output_format and _TIME_RE.search(output_format) and not time_format:
         print("%T is in --format string, but --timefmt was not specified.", flush=True)
         sys.exit(1)
 
     # assign format and timefmt
-    global _format_string, _timefmt_string
-    _format_string = output_format
-    _timefmt_string = time_format
+    global _format_output
+    _format_output = _compile_format(output_format or '%w %e %f', time_format)
 
     # verbose setting if verbose mode
     global _print_verbose
@@ -214,15 +376,6 @@ https://docs.python.org/ja/3/library/datetime.html#strftime-and-strptime-format-
     _print_verbose(argv)
 
 
-    # set status code at timeout
-    signal.signal(signal.SIGQUIT, _handler)
-
-    # reveal watch descriptor
-    global _watch_descriptors
-    def reveal_watch_descriptors(signum, frame):
-        print(_watch_descriptors, flush=True)
-    signal.signal(signal.SIGUSR1, reveal_watch_descriptors)
-
     # parse event option input
     events = []
     for events_input in events_inputs:
@@ -253,72 +406,97 @@ https://docs.python.org/ja/3/library/datetime.html#strftime-and-strptime-format-
     _print_verbose(f"include create events: {_include_create_event}")
 
     print('watching {} for inotify events: {}'.format(
-        target_paths, ",".join(_decode_flag(mask))), file=sys.stderr, flush=True)
+        target_paths, _flag_string(mask)), file=sys.stderr, flush=True)
 
+    # block SIGQUIT and SIGUSR1 from here on. _detect receives them through a signalfd.
+    _block_signals()
     try:
-        fd = inotify_init()
+        fd = inotify_init1(_IN_NONBLOCK)
         paths = []
-        for path in target_paths:
-            path = os.path.normpath(path)
-            if not pathlib.Path(path).exists():
-                raise FileNotFoundError(f"specified file is not exist: {path}")
-            if pathlib.Path(path).is_dir():
-                paths.append(path.rstrip(os.sep) + os.sep)
-                if recursive_mode:
-                    # walk directory tree when recusive mode
-                    for root, dirs, _ in os.walk(path):
-                        for d in dirs:
-                            paths.append(root + os.path.sep + d.rstrip(os.sep) + os.sep)
-            else:
-                paths.append(path)
-        # assign watch descriptor to each target directory
-        for path in paths:
-            wd = inotify_add_watch(fd, path.encode(), mask)
-            _print_verbose("inotify_add_watch {} {} {} => {}".format(fd, path, ",".join(_decode_flag(mask)), wd))
-            _watch_descriptors[wd] = path
+        # scandir and inotify_add_watch release the GIL, so a thread pool overlaps their syscalls on large trees
+        with ThreadPoolExecutor() as executor:
+            for path in target_paths:
+                path = os.path.normpath(path)
+                # a single stat tells both existence and type
+                try:
+                    st = os.stat(path)
+                except (FileNotFoundError, NotADirectoryError):
+                    raise FileNotFoundError(f"specified file is not exist: {path}")
+                if stat.S_ISDIR(st.st_mode):
+                    paths.append(path.rstrip(os.sep) + os.sep)
+                    if recursive_mode:
+                        # walk directory tree when recusive mode
+                        paths.extend(_walk_directories(path, executor))
+                else:
+                    paths.append(path)
+            # assign watch descriptor to each target directory
+            _add_watches(fd, paths, mask, executor)
+        # same notice as inotifywait, tells a caller that events from here on are caught
+        print("Watches established.", file=sys.stderr, flush=True)
+        # start the generator, from then on its finally restores the signal mask even if it is dropped unused
+        detected = _detect(fd, mask, monitor_mode, recursive_mode, timeout)
+        next(detected)
         # output generator if monitor mode, else a row elements.
         if monitor_mode:
-            return _detect(fd, mask, monitor_mode, recursive_mode, timeout)
+            return detected
         else:
-            return next(_detect(fd, mask, monitor_mode, recursive_mode, timeout))
+            return next(detected)
         _status_code = 0
     except FileNotFoundError as e:
         _print_verbose(e)
+        _release_signals()
         _status_code = 1
+    except BaseException:
+        # any other failure while setting up leaves the caller's signal mask as it was
+        _release_signals()
+        raise
     return _status_code
 
 def _detect(fd, mask, monitor_mode=False, recursive_mode=False, timeout=0):
+    # wait on the inotify fd and the signalfd
+    poller = select.epoll()
+    signal_fd = -1
+    # directories created while watching recursively may bring whole trees, e.g. cp -r or tar x
+    executor = ThreadPoolExecutor() if recursive_mode else None
     try:
+        # edge-triggered is enough, _detect_inotify always reads the inotify fd until it runs dry
+        poller.register(fd, select.EPOLLIN | select.EPOLLET)
+        signal_fd = _open_signalfd(_owned_signals())
+        poller.register(signal_fd, select.EPOLLIN)
+        # wait() runs the generator up to here before handing it out
+        yield
         deleting_watch_descriptor = None
         global _include_create_event
+        # the timeout counts from the last inotify events read, not from the last wakeup
+        deadline = time.monotonic() + timeout if timeout > 0 else None
         while True:
-            gen_detected = _detect_inotify(fd, timeout)
+            received = False
+            gen_detected = _detect_inotify(fd, poller, signal_fd, deadline)
             for detected in gen_detected:
-                [wd, flags, name] = detected
+                received = True
+                wd, flags, name = detected
                 directory = _watch_descriptors[wd]
+                # name arrives as raw bytes and is decoded once here
+                name = os.fsdecode(name)
                 # IGNORED event to skip print
-                if not ((flags & _EVENTS['IGNORED'] != 0) or
-                        (flags & _EVENTS['CREATE'] != 0) and not _include_create_event):
-                    # output an inotify detection result
-                    yield directory, _decode_flag(flags), name.replace('\0', '')
+                if not ((flags & _MASK_IGNORED) or
+                        (flags & _MASK_CREATE) and not _include_create_event):
+                    # output an inotify detection result. the memoized tuple is shared, callers get their own list
+                    yield directory, list(_decode_flag(flags)), name
 
                 if recursive_mode:
                     # if directory is created, add it to watch
-                    if (flags & _EVENTS['CREATE'] != 0) and (flags & _EVENTS['ISDIR'] != 0):
+                    if (flags & _MASK_CREATE_ISDIR) == _MASK_CREATE_ISDIR:
                         ##path = directory + name.rstrip(os.sep).replace('\0', '') + os.sep
-                        path = directory + name.replace('\0', '') + os.sep
+                        path = directory + name + os.sep
                         # assuming file or directory made in the catched directory, add watch of them recursively
-                        for dirpath, _, _ in os.walk(path):
-                            path = dirpath
-                            wd = inotify_add_watch(fd, path.encode(), mask)
-                            _print_verbose("inotify_add_watch {} {} {} => {}".format(fd, path, ",".join(_decode_flag(mask)), wd))
-                            _watch_descriptors[wd] = path
+                        _add_watches(fd, [path, *_walk_directories(path, executor)], mask, executor)
                     # if directory is deleted, remove it from watch
-                    elif (flags & _EVENTS['DELETE_SELF'] != 0):
+                    elif (flags & _MASK_DELETE_SELF):
                         _print_verbose("deleting watch descriptor {}".format(wd))
                         deleting_watch_descriptor = wd
                     #elif (flags & _EVENTS['IGNORED'] != 0):
-                    elif (flags & _EVENTS['DELETE'] != 0) and (flags & _EVENTS['ISDIR'] != 0):
+                    elif (flags & _MASK_DELETE_ISDIR) == _MASK_DELETE_ISDIR:
                         if not deleting_watch_descriptor:
                             _print_verbose("cannot find deleting_watch_descriptor {}".format(deleting_watch_descriptor))
                             continue
@@ -326,13 +504,18 @@ def _detect(fd, mask, monitor_mode=False, recursive_mode=False, timeout=0):
                         inotify_rm_watch(fd, deleting_watch_descriptor)
                         del _watch_descriptors[deleting_watch_descriptor]
                         deleting_watch_descriptor = None
+            if received and deadline is not None:
+                deadline = time.monotonic() + timeout
     finally:
-        global _process
-        if _process:
-            _process.kill()
-        for wd in _watch_descriptors.keys():
-            inotify_rm_watch(fd, wd)
+        if executor:
+            executor.shutdown(wait=False)
+        poller.close()
+        if signal_fd >= 0:
+            os.close(signal_fd)
+        _release_signals()
+        # closing the inotify fd releases all of its watches in the kernel
         os.close(fd)
+        _watch_descriptors.clear()
 
 if __name__ == '__main__':
     detect_results = wait(sys.argv[1:])
@@ -1,8 +1,9 @@
 from datetime import datetime
+import importlib.util
 import multiprocessing
 import os
 import pytest
-import shutil
+import selectors
 import signal
 import subprocess
 import tempfile
@@ -11,503 +12,462 @@ import time
 command = ["python3", "inotify.py"]
 #command = ["inotifywait"]
 
-def test_inotifywait_file_creation():
-    """
-    Test that inotifywait detects file creation events.
-    """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_file = os.path.join(watched_dir, "testfile.txt")
-
-        # Start inotifywait as a subprocess to monitor the directory
-        #cmd = [*command, "-e", "create", watched_dir]
-        cmd = [*command, "-m", "-e", "create", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+# Command as a tuple, so each test only concatenates its own arguments
+_BASE = tuple(command)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+# Default output format of inotifywait, "%w %e %f"
+EXPECTED_FMT = "{dir}/ {event} {name}"
 
-            # Create a file in the watched directory
-            with open(test_file, "w") as f:
-                f.write("This is a test file.")
+# Memory-backed file system for temporary directories, or None for the default location
+TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
-            
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ CREATE testfile.txt"
-            assert expected_output in stdout_line
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+# Seconds to wait for inotifywait to report that its watches are established
+READY_TIMEOUT = 5.0
 
-def test_inotifywait_timeout():
+@pytest.fixture
+def watcher_factory():
     """
-    Test that inotifywait respects the --timeout option.
+    Start inotifywait with the given arguments, and terminate every started process at teardown.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-
-        # Start inotifywait with a timeout of 2 seconds
-        cmd = [*command, "--timeout", "2", "-e", "create", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    processes = []
 
-        try:
-            # Wait for timeout
-            time.sleep(3)
+    def start(*args, **kwargs):
+        process = subprocess.Popen(_BASE + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, **kwargs)
+        processes.append(process)
+        # Wait until inotifywait reports its watches are in place, instead of sleeping
+        fd = process.stderr.fileno()
+        stderr = bytearray()
+        deadline = time.monotonic() + READY_TIMEOUT
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while b"Watches established." not in stderr:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    pytest.fail(f"inotifywait did not establish watches within {READY_TIMEOUT} seconds")
+                data = os.read(fd, 4096)
+                if not data:
+                    pytest.fail(f"inotifywait exited before establishing watches: {process.wait()}")
+                stderr += data
+        return process
 
-            # Wait for the process to finish
-            stdout, stderr = process.communicate()
+    yield start
 
-            # Verify that inotifywait timed out without events when the return code is assumed as 2
-            return_code = process.returncode
-            assert return_code == 2
+    # Stop the inotifywait processes
+    for process in processes:
+        _stop(process)
+        _pending_output.pop(process, None)
 
-        finally:
-            # Ensure the process is terminated
-            if process.poll() is None:
-                process.terminate()
-                process.wait()
-
-def test_inotifywait_file_modification():
+def _stop(process):
     """
-    Test that inotifywait detects file modification events.
+    Kill inotifywait without waiting for a graceful shutdown, which the tests do not need.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_file = os.path.join(watched_dir, "testfile.txt")
+    process.kill()
+    try:
+        process.wait(timeout=0.5)
+    except subprocess.TimeoutExpired:
+        pass
 
-        # Create a file to be modified
-        with open(test_file, "w") as f:
-            f.write("Initial content.")
-
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "modify", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+@pytest.fixture
+def watched_dir():
+    """
+    Directory to be watched, on tmpfs when available so file operations in tests never touch a disk.
+    """
+    with tempfile.TemporaryDirectory(dir=TMPFS_DIR) as tempdir:
+        yield tempdir
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+# Output already read from a watcher that does not make a complete line yet
+_pending_output = {}
 
-            # Modify the file
-            with open(test_file, "a") as f:
-                f.write("Additional content.")
+def _read_lines(process, n, timeout):
+    """
+    Drain inotifywait output until n complete lines are buffered or timeout passes, and return the complete lines.
+    """
+    fd = process.stdout.fileno()
+    buffer = _pending_output.setdefault(process, bytearray())
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while buffer.count(b"\n") < n:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                break
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            buffer += data
+    *lines, rest = buffer.split(b"\n", n)
+    _pending_output[process] = rest
+    return [os.fsdecode(bytes(line)) for line in lines]
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+def read_line(process, timeout=2.0):
+    """
+    Read one line of inotifywait output without the newline, or return None if no line arrives within timeout.
+    """
+    lines = _read_lines(process, 1, timeout)
+    return lines[0] if lines else None
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ MODIFY testfile.txt"
-            assert expected_output in stdout_line
+def collect_lines(process, n=2, timeout=2.0):
+    """
+    Read n lines of inotifywait output as a set, with a single timeout for all of them.
+    """
+    return set(_read_lines(process, n, timeout))
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+def touch(path, data=b"x"):
+    """
+    Create or truncate a file and write data to it, without the overhead of a file object.
+    """
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
-def test_inotifywait_file_deletion():
+def test_inotifywait_file_creation(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects file deletion events.
+    Test that inotifywait detects file creation events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_file = os.path.join(watched_dir, "testfile.txt")
+    test_file = os.path.join(watched_dir, "testfile.txt")
 
-        # Create a file to be deleted
-        with open(test_file, "w") as f:
-            f.write("This file will be deleted.")
+    # Start inotifywait as a subprocess to monitor the directory
+    #cmd = _BASE + ("-e", "create", watched_dir)
+    process = watcher_factory("-m", "-e", "create", watched_dir)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "delete", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create a file in the watched directory
+    touch(test_file)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
+    
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="CREATE", name="testfile.txt")
+    assert stdout_line == expected_output
 
-            # Delete the file
-            os.remove(test_file)
+def test_inotifywait_timeout(watched_dir):
+    """
+    Test that inotifywait respects the --timeout option.
+    """
+    # Start inotifywait with a timeout of 2 seconds
+    cmd = _BASE + ("--timeout", "2", "-e", "create", watched_dir)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+    try:
+        # Wait for the process to finish by the timeout
+        stdout, stderr = process.communicate(timeout=5)
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ DELETE testfile.txt"
-            assert expected_output in stdout_line
+        # Verify that inotifywait timed out without events when the return code is assumed as 2
+        return_code = process.returncode
+        assert return_code == 2
 
-        finally:
-            # Terminate the inotifywait process
+    finally:
+        # Ensure the process is terminated
+        if process.poll() is None:
             process.terminate()
             process.wait()
 
-def test_inotifywait_directory_creation():
+def test_inotifywait_timeout_not_restarted_by_signal(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects directory creation events.
+    Test that printing watch descriptors on SIGUSR1 does not restart the --timeout.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_subdir = os.path.join(watched_dir, "subdir")
-
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "create", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Start inotifywait with a timeout of 2 seconds
+    process = watcher_factory("--timeout", "2", "-e", "create", watched_dir)
+    start = time.monotonic()
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Keep signaling much more often than the timeout until inotifywait exits
+    while process.poll() is None and time.monotonic() - start < 6:
+        process.send_signal(signal.SIGUSR1)
+        time.sleep(0.1)
 
-            # Create a subdirectory
-            os.mkdir(test_subdir)
+    # Verify that inotifywait timed out at the 2 second deadline, not only after the signals stopped
+    assert process.wait(timeout=1) == 2
+    assert time.monotonic() - start < 4
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+def test_inotifywait_timeout_exit_while_signaled(watched_dir, watcher_factory):
+    """
+    Test that a SIGUSR1 arriving while inotifywait exits by --timeout does not change the exit status.
+    """
+    # Start inotifywait with a short timeout
+    process = watcher_factory("--timeout", "0.3", "-e", "create", watched_dir)
+    start = time.monotonic()
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ CREATE,ISDIR subdir"
-            assert expected_output in stdout_line
+    # Keep signaling until after inotifywait has exited
+    while process.poll() is None and time.monotonic() - start < 5:
+        process.send_signal(signal.SIGUSR1)
+        time.sleep(0.002)
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Verify that inotifywait exited with the timeout status, not killed by the signal
+    assert process.wait(timeout=1) == 2
 
-def test_inotifywait_file_move():
+def test_inotifywait_file_modification(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects file move events.
+    Test that inotifywait detects file modification events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        source_file = os.path.join(watched_dir, "source.txt")
-        dest_file = os.path.join(watched_dir, "dest.txt")
+    test_file = os.path.join(watched_dir, "testfile.txt")
 
-        # Create a file to be moved
-        with open(source_file, "w") as f:
-            f.write("This file will be moved.")
+    # Create a file to be modified
+    touch(test_file)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "move", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "modify", watched_dir)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Modify the file
+    with open(test_file, "a") as f:
+        f.write("Additional content.")
 
-            # Move the file
-            os.rename(source_file, dest_file)
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-            # Wait for inotifywait output
-            stdout_output = { process.stdout.readline().strip(), 
-                            process.stdout.readline().strip() }
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="MODIFY", name="testfile.txt")
+    assert stdout_line == expected_output
 
-            # Check if inotifywait output matches the expected event
-            expected_output = { f"{watched_dir}/ MOVED_TO dest.txt", 
-                                f"{watched_dir}/ MOVED_FROM source.txt" }
-            assert expected_output == stdout_output
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
-
-def test_inotifywait_recursive():
+def test_inotifywait_file_deletion(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects events recursively in subdirectories.
+    Test that inotifywait detects file deletion events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        subdir = os.path.join(watched_dir, "subdir")
-        os.mkdir(subdir)
-        test_file = os.path.join(subdir, "testfile.txt")
-
-        # Start inotifywait as a subprocess to monitor the directory recursively
-        cmd = [*command, "-m", "-r", "-e", "create", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    test_file = os.path.join(watched_dir, "testfile.txt")
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Create a file to be deleted
+    touch(test_file)
 
-            # Create a file in the subdirectory
-            with open(test_file, "w") as f:
-                f.write("This is a test file.")
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "delete", watched_dir)
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+    # Delete the file
+    os.remove(test_file)
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{subdir}/ CREATE testfile.txt"
-            assert expected_output in stdout_line
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="DELETE", name="testfile.txt")
+    assert stdout_line == expected_output
 
-def test_inotifywait_symlink_deletion():
+def test_inotifywait_directory_creation(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects symlink deletion events.
+    Test that inotifywait detects directory creation events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        target_file = os.path.join(watched_dir, "target.txt")
-        symlink = os.path.join(watched_dir, "symlink.txt")
+    test_subdir = os.path.join(watched_dir, "subdir")
 
-        # Create a target file and symlink
-        with open(target_file, "w") as f:
-            f.write("This is a target file.")
-        os.symlink(target_file, symlink)
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "create", watched_dir)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "delete", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create a subdirectory
+    os.mkdir(test_subdir)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-            # Delete the symlink
-            os.remove(symlink)
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="CREATE,ISDIR", name="subdir")
+    assert stdout_line == expected_output
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+@pytest.mark.parametrize("create, source, dest, flags", [
+    (touch, "source.txt", "dest.txt", ""),
+    (touch, "original.txt", "renamed.txt", ""),
+    (os.mkdir, "original_dir", "renamed_dir", ",ISDIR"),
+], ids=["file_move", "file_rename", "directory_rename"])
+def test_inotifywait_move(watched_dir, watcher_factory, create, source, dest, flags):
+    """
+    Test that inotifywait detects file and directory move events.
+    """
+    source_path = os.path.join(watched_dir, source)
+    dest_path = os.path.join(watched_dir, dest)
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ DELETE symlink.txt"
-            assert expected_output in stdout_line
+    # Create a file or directory to be moved
+    create(source_path)
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "move", watched_dir)
 
-def test_inotifywait_directory_deletion():
-    """
-    Test that inotifywait detects directory deletion events.
-    """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_subdir = os.path.join(watched_dir, "subdir")
+    # Move the file or directory
+    os.rename(source_path, dest_path)
 
-        # Create a subdirectory
-        os.mkdir(test_subdir)
+    # Wait for inotifywait output
+    stdout_output = collect_lines(process, 2)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "delete", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Check if inotifywait output matches the expected event
+    expected_output = { EXPECTED_FMT.format(dir=watched_dir, event="MOVED_TO" + flags, name=dest),
+                        EXPECTED_FMT.format(dir=watched_dir, event="MOVED_FROM" + flags, name=source) }
+    assert expected_output == stdout_output
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+def test_inotifywait_recursive(watched_dir, watcher_factory):
+    """
+    Test that inotifywait detects events recursively in subdirectories.
+    """
+    subdir = os.path.join(watched_dir, "subdir")
+    os.mkdir(subdir)
+    test_file = os.path.join(subdir, "testfile.txt")
 
-            # Delete the subdirectory
-            os.rmdir(test_subdir)
+    # Start inotifywait as a subprocess to monitor the directory recursively
+    process = watcher_factory("-m", "-r", "-e", "create", watched_dir)
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+    # Create a file in the subdirectory
+    touch(test_file)
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ DELETE,ISDIR subdir"
-            assert expected_output in stdout_line
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=subdir, event="CREATE", name="testfile.txt")
+    assert stdout_line == expected_output
 
-def test_inotifywait_multiple_events():
+def test_inotifywait_symlink_deletion(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects multiple events in sequence.
+    Test that inotifywait detects symlink deletion events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_file = os.path.join(watched_dir, "testfile.txt")
+    target_file = os.path.join(watched_dir, "target.txt")
+    symlink = os.path.join(watched_dir, "symlink.txt")
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "create,modify", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create a target file and symlink
+    touch(target_file)
+    os.symlink(target_file, symlink)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "delete", watched_dir)
 
-            # Create a file
-            with open(test_file, "w") as f:
-                f.write("Initial content.")
+    # Delete the symlink
+    os.remove(symlink)
 
-            # Wait for the create event
-            stdout_line_create = process.stdout.readline().strip()
-            expected_output_create = f"{watched_dir}/ CREATE testfile.txt"
-            assert expected_output_create in stdout_line_create
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-            # Modify the file
-            with open(test_file, "a") as f:
-                f.write(" Additional content.")
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="DELETE", name="symlink.txt")
+    assert stdout_line == expected_output
 
-            # Wait for the modify event
-            stdout_line_modify = process.stdout.readline().strip()
-            expected_output_modify = f"{watched_dir}/ MODIFY testfile.txt"
-            assert expected_output_modify in stdout_line_modify
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
-
-def test_inotifywait_file_access():
+def test_inotifywait_directory_deletion(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects file access events.
+    Test that inotifywait detects directory deletion events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_file = os.path.join(watched_dir, "testfile.txt")
-
-        # Create a file to be accessed
-        with open(test_file, "w") as f:
-            f.write("This file will be accessed.")
+    test_subdir = os.path.join(watched_dir, "subdir")
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "access", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create a subdirectory
+    os.mkdir(test_subdir)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "delete", watched_dir)
 
-            # Access the file
-            with open(test_file, "r") as f:
-                _ = f.read()
+    # Delete the subdirectory
+    os.rmdir(test_subdir)
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ ACCESS testfile.txt"
-            assert expected_output in stdout_line
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="DELETE,ISDIR", name="subdir")
+    assert stdout_line == expected_output
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
-
-def test_inotifywait_file_rename():
+def test_inotifywait_multiple_events(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects file rename events.
+    Test that inotifywait detects multiple events in sequence.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        original_file = os.path.join(watched_dir, "original.txt")
-        renamed_file = os.path.join(watched_dir, "renamed.txt")
+    test_file = os.path.join(watched_dir, "testfile.txt")
 
-        # Create a file
-        with open(original_file, "w") as f:
-            f.write("This file will be renamed.")
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "create,modify", watched_dir)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "move", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create a file
+    touch(test_file)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Wait for the create event
+    stdout_line_create = read_line(process)
+    expected_output_create = EXPECTED_FMT.format(dir=watched_dir, event="CREATE", name="testfile.txt")
+    assert stdout_line_create == expected_output_create
 
-            # Rename the file
-            os.rename(original_file, renamed_file)
+    # Modify the file
+    with open(test_file, "a") as f:
+        f.write(" Additional content.")
 
-            # Wait for inotifywait output
-            stdout_output = { process.stdout.readline().strip(), 
-                            process.stdout.readline().strip() }
+    # Wait for the modify event
+    stdout_line_modify = read_line(process)
+    expected_output_modify = EXPECTED_FMT.format(dir=watched_dir, event="MODIFY", name="testfile.txt")
+    assert stdout_line_modify == expected_output_modify
 
-            # Check if inotifywait output matches the expected event
-            expected_output = { f"{watched_dir}/ MOVED_TO renamed.txt",
-                                f"{watched_dir}/ MOVED_FROM original.txt" }
-            assert expected_output == stdout_output
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
-
-def test_inotifywait_directory_rename():
+def test_inotifywait_sequence(watched_dir, watcher_factory):
     """
-    Test that inotifywait detects directory rename events.
+    Test that a single inotifywait reports a sequence of different events in order.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        original_dir = os.path.join(watched_dir, "original_dir")
-        renamed_dir = os.path.join(watched_dir, "renamed_dir")
+    test_file = os.path.join(watched_dir, "testfile.txt")
+    renamed_file = os.path.join(watched_dir, "renamed.txt")
+    test_subdir = os.path.join(watched_dir, "subdir")
 
-        # Create a directory
-        os.mkdir(original_dir)
+    # Start one inotifywait for every event in the sequence
+    process = watcher_factory("-m", "-e", "create,modify,access,move,delete", watched_dir)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "move", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create and write a file, read it, rename it, then create and delete a subdirectory and delete the file
+    touch(test_file)
+    with open(test_file, "r") as f:
+        _ = f.read()
+    os.rename(test_file, renamed_file)
+    os.mkdir(test_subdir)
+    os.rmdir(test_subdir)
+    os.remove(renamed_file)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Check if inotifywait output matches the expected events in order
+    expected_events = [
+        ("CREATE", "testfile.txt"),
+        ("MODIFY", "testfile.txt"),
+        ("ACCESS", "testfile.txt"),
+        ("MOVED_FROM", "testfile.txt"),
+        ("MOVED_TO", "renamed.txt"),
+        ("CREATE,ISDIR", "subdir"),
+        ("DELETE,ISDIR", "subdir"),
+        ("DELETE", "renamed.txt"),
+    ]
+    for event, name in expected_events:
+        assert read_line(process) == EXPECTED_FMT.format(dir=watched_dir, event=event, name=name)
 
-            # Rename the directory
-            os.rename(original_dir, renamed_dir)
+def test_inotifywait_file_access(watched_dir, watcher_factory):
+    """
+    Test that inotifywait detects file access events.
+    """
+    test_file = os.path.join(watched_dir, "testfile.txt")
 
-            # Wait for inotifywait output
-            stdout_output = { process.stdout.readline().strip(),
-                            process.stdout.readline().strip() }
+    # Create a file to be accessed
+    touch(test_file)
 
-            # Check if inotifywait output matches the expected event
-            expected_output = { f"{watched_dir}/ MOVED_TO,ISDIR renamed_dir",
-                                f"{watched_dir}/ MOVED_FROM,ISDIR original_dir" }
-            assert expected_output == stdout_output
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "access", watched_dir)
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Access the file
+    with open(test_file, "r") as f:
+        _ = f.read()
 
-def test_inotifywait_file_copy():
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
+
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="ACCESS", name="testfile.txt")
+    assert stdout_line == expected_output
+
+def test_inotifywait_file_copy(watched_dir, watcher_factory):
     """
     Test that inotifywait detects file copy events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        original_file = os.path.join(watched_dir, "original.txt")
-        copied_file = os.path.join(watched_dir, "copied.txt")
+    original_file = os.path.join(watched_dir, "original.txt")
+    copied_file = os.path.join(watched_dir, "copied.txt")
 
-        # Create a file
-        with open(original_file, "w") as f:
-            f.write("This file will be copied.")
+    # Create a file
+    touch(original_file)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "create", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "create", watched_dir)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Copy the file as a hard link, which creates the new name without copying data
+    os.link(original_file, copied_file)
 
-            # Copy the file
-            shutil.copy2(original_file, copied_file)
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
+    # Check if inotifywait output matches the expected event
+    expected_output = EXPECTED_FMT.format(dir=watched_dir, event="CREATE", name="copied.txt")
+    assert stdout_line == expected_output
 
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{watched_dir}/ CREATE copied.txt"
-            assert expected_output in stdout_line
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
-
-def test_inotifywait_no_event_outside_watched_dir():
+def test_inotifywait_no_event_outside_watched_dir(watcher_factory):
     """
     Test that inotifywait does not detect events outside the watched directory.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
+    with tempfile.TemporaryDirectory(dir=TMPFS_DIR) as tempdir:
         watched_dir = os.path.join(tempdir, "watched")
         outside_dir = os.path.join(tempdir, "outside")
         test_file = os.path.join(outside_dir, "testfile.txt")
@@ -517,148 +477,93 @@ def test_inotifywait_no_event_outside_watched_dir():
         os.mkdir(outside_dir)
 
         # Start inotifywait as a subprocess to monitor the watched directory
-        cmd = [*command, "-m", "-e", "create", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        try:
-            stdout = None
-            try:
-                # consume message to standard output
-                stdout, stderr = process.communicate(timeout=1)
-            except subprocess.TimeoutExpired:
-                pass
-
-            # Create a file outside the watched directory
-            with open(test_file, "w") as f:
-                f.write("This is outside the watched directory.")
-
-            try:
-                # Ensure no output is generated for the outside event
-                #time.sleep(1)  # Wait to ensure no event is detected
-                stdout, stderr = process.communicate(timeout=1)
-            except subprocess.TimeoutExpired:
-                assert stdout == None
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+        process = watcher_factory("-m", "-e", "create", watched_dir)
+
+        # Create a file outside the watched directory
+        touch(test_file)
 
-def test_inotifywait_create_directory_in_directory_created():
+        # Ensure no output is generated for the outside event, while inotifywait keeps running
+        assert read_line(process, timeout=1.0) is None
+        assert process.poll() is None
+
+def test_inotifywait_create_directory_in_directory_created(watched_dir, watcher_factory):
     """
     Test that inotifywait detects directory creation events.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_create_dir = os.path.join(watched_dir, "create_dir")
-        test_subdir = os.path.join(test_create_dir, "subdir")
-
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-r", watched_dir]
-        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        try:
-            # Create a directory
-            os.mkdir(test_create_dir)
-
-            # Give inotifywait some time to start
-            time.sleep(1)
-
-            # Create a subdirectory
-            os.mkdir(test_subdir)
-
-            stdout_line = []
-
-            # Set timeout alarm
-            #def raise_exception(signum, frame):
-            #    raise TimeoutError
-            #signal.signal(signal.SIGALRM, raise_exception)
-            signal.signal(signal.SIGALRM, lambda signum, frame: exec('raise TimeoutError'))
-            signal.alarm(2)
-            try:
-                while True:
-                    line = process.stdout.readline().rstrip()
-                    stdout_line.append(line)
-            except TimeoutError:
-                pass
-            finally:
-                pass
-                #print(stdout_line)
-
-            # Check if inotifywait output matches the expected event
-            expected_output = f"{test_create_dir}/ CREATE,ISDIR subdir"
-            assert expected_output in stdout_line
-
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    test_create_dir = os.path.join(watched_dir, "create_dir")
+    test_subdir = os.path.join(test_create_dir, "subdir")
 
-def test_inotifywait_print_timestamp():
-    """
-    Test that inotifywait print timestamp option
-    """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_subdir = os.path.join(watched_dir, "testdir")
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-r", watched_dir, stdin=subprocess.PIPE)
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "create", "--format", "%T", "--timefmt", "%Y/%m/%d %H:%M", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Create a directory
+    os.mkdir(test_create_dir)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Give inotifywait some time to add a watch to the created directory
+    time.sleep(1)
 
-            # Get current time
-            current_time = datetime.now()
-            # Create a subdirectory
-            os.mkdir(test_subdir)
+    # Create a subdirectory
+    os.mkdir(test_subdir)
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().strip()
-            
-            # Check if inotifywait output matches the expected event
-            expected_output = current_time.strftime("%Y/%m/%d %H:%M")
-            assert expected_output == stdout_line
+    expected_output = EXPECTED_FMT.format(dir=test_create_dir, event="CREATE,ISDIR", name="subdir")
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Read output until the expected event arrives or inotifywait stays silent
+    stdout_line = []
+    line = read_line(process)
+    while line is not None:
+        stdout_line.append(line)
+        if line == expected_output:
+            break
+        line = read_line(process)
+
+    # Check if inotifywait output matches the expected event
+    assert expected_output in stdout_line
 
-def test_inotifywait_print_with_format():
+def test_inotifywait_print_timestamp(watched_dir, watcher_factory):
     """
-    Test that inotifywait print format option
+    Test that inotifywait print timestamp option
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        watched_dir = tempdir
-        test_subdir = os.path.join(watched_dir, "testdir")
+    test_subdir = os.path.join(watched_dir, "testdir")
 
-        # Start inotifywait as a subprocess to monitor the directory
-        cmd = [*command, "-m", "-e", "create", "--format", "%f %e %:e %|e %::e %%e %w", watched_dir]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "create", "--format", "%T", "--timefmt", "%Y/%m/%d %H:%M", watched_dir)
 
-        try:
-            # Give inotifywait some time to start
-            time.sleep(1)
+    # Get current time
+    current_time = datetime.now()
+    # Create a subdirectory
+    os.mkdir(test_subdir)
 
-            # Create a subdirectory
-            os.mkdir(test_subdir)
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
+    
+    # Check if inotifywait output matches the expected event
+    expected_output = current_time.strftime("%Y/%m/%d %H:%M")
+    assert expected_output == stdout_line
 
-            # Wait for inotifywait output
-            stdout_line = process.stdout.readline().rstrip()
-            #print(stdout_line)
-            
-            # Check if inotifywait output matches the expected event
-            expected_output = f"testdir CREATE,ISDIR CREATE:ISDIR CREATE|ISDIR %::e %e {watched_dir}/"
-            assert expected_output == stdout_line
+def test_inotifywait_print_with_format(watched_dir, watcher_factory):
+    """
+    Test that inotifywait print format option
+    """
+    test_subdir = os.path.join(watched_dir, "testdir")
 
-        finally:
-            # Terminate the inotifywait process
-            process.terminate()
-            process.wait()
+    # Start inotifywait as a subprocess to monitor the directory
+    process = watcher_factory("-m", "-e", "create", "--format", "%f %e %:e %|e %::e %%e %w", watched_dir)
+
+    # Create a subdirectory
+    os.mkdir(test_subdir)
+
+    # Wait for inotifywait output
+    stdout_line = read_line(process)
+    #print(stdout_line)
+    
+    # Check if inotifywait output matches the expected event
+    expected_output = f"testdir CREATE,ISDIR CREATE:ISDIR CREATE|ISDIR %::e %e {watched_dir}/"
+    assert expected_output == stdout_line
 
 if __name__ == "__main__":
-    pytest.main(["-v", __file__])
+    args = ["-v", __file__]
+    # Each test watches its own temporary directory, so they can run in parallel with pytest-xdist
+    if importlib.util.find_spec("xdist"):
+        args += ["-n", "auto"]
+    pytest.main(args)
 